@@ -7,8 +7,9 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from routes import caption_router, generate_router, health_router, upscale_router
-from services.capabilities import get_capabilities
+from services.capabilities import capability_keys, get_capabilities
 from services.captioner import captioner
+from services.generator import generator
 from services.queue import gpu_queue
 from services.upscaler import upscaler
 
@@ -27,6 +28,9 @@ async def lifespan(app: FastAPI):
     caps = get_capabilities()
     logger.info(f"Detected capabilities: {caps}")
 
+    # Routes check requests against this set instead of re-deriving capabilities
+    app.state.allowed = capability_keys()
+
     # Extract capability lists
     upscale_caps = [c for c in caps["capabilities"] if c["kind"] == "upscale"]
     image_caps = [c for c in caps["capabilities"] if c["kind"] == "image"]
@@ -54,6 +58,9 @@ async def lifespan(app: FastAPI):
     yield
 
     # Shutdown
+    await captioner.stop()
+    await generator.stop()
+    await upscaler.stop()
     await gpu_queue.stop()
     logger.info("AI server shutdown complete")
 
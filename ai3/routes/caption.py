@@ -2,12 +2,13 @@
 
 from typing import Annotated, Literal
 
-from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
 from pydantic import BaseModel
 
-from services.capabilities import require_caption
+from routes.deps import get_allowed
+from services.batcher import QueueFullError
+from services.capabilities import CapabilityKey, require_caption
 from services.captioner import captioner
-from services.queue import gpu_queue
 
 router = APIRouter(prefix="/api")
 
@@ -22,34 +23,36 @@ class CaptionResponse(BaseModel):
 @router.post("/caption")
 async def caption(
     image: Annotated[UploadFile, File()],
+    allowed: Annotated[frozenset[CapabilityKey], Depends(get_allowed)],
     model: Annotated[
         Literal["blip2", "florence2-base", "florence2-large"], Form()
     ] = "florence2-base",
+    detail: Annotated[bool, Form()] = False,
 ) -> CaptionResponse:
     """Generate a caption for an image.
 
     Args:
         image: Image file to caption
         model: Model to use (blip2, florence2-base, florence2-large)
+        detail: Use beam search for a more thorough caption (slower, Florence-2 only)
 
     Returns:
         JSON with caption string
     """
     # Check capability
     try:
-        require_caption(model)
+        require_caption(model, allowed)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e)) from None
 
-    # Read image data
-    image_bytes = await image.read()
-
-    # Submit to GPU queue
-    async def do_caption():
-        return await captioner.caption(image_bytes, model=model)
-
+    # Captioner batches concurrent requests and submits them to the GPU queue.
+    # The spooled upload file is decoded in place rather than read into memory.
     try:
-        result = await gpu_queue.submit(do_caption)
+        result = await captioner.caption(image.file, model=model, detail=detail)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e)) from None
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Captioning failed: {e}") from None
 
@@ -0,0 +1,10 @@
+"""Shared route dependencies."""
+
+from fastapi import Request
+
+from services.capabilities import CapabilityKey
+
+
+def get_allowed(request: Request) -> frozenset[CapabilityKey]:
+    """Available capability keys, computed once at startup."""
+    return request.app.state.allowed
@@ -1,14 +1,16 @@
 """Image generation route."""
 
-from typing import Literal
+from typing import Annotated, Literal
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
 from fastapi.responses import Response
 from pydantic import BaseModel, Field
 
-from services.capabilities import require_generate
+from routes.deps import get_allowed
+from services.batcher import QueueFullError
+from services.capabilities import CapabilityKey, require_generate
+from services.encoding import encode_jpeg, encode_png
 from services.generator import generator
-from services.queue import gpu_queue
 
 router = APIRouter(prefix="/api")
 
@@ -29,22 +31,60 @@ class GenerateRequest(BaseModel):
     model: LocalModel = Field("sdxl", description="Model to use")
 
 
+def _quality(accept: str, media_type: str) -> float:
+    """q-value an Accept header gives a media type, from its most specific matching range."""
+    kind = media_type.split("/", 1)[0]
+    quality, specificity = 0.0, -1
+    for part in accept.split(","):
+        media_range, *params = (item.strip() for item in part.split(";"))
+        if media_range == media_type:
+            match = 2
+        elif media_range == f"{kind}/*":
+            match = 1
+        elif media_range == "*/*":
+            match = 0
+        else:
+            continue
+        if match <= specificity:
+            continue
+
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality, specificity = q, match
+    return quality
+
+
 @router.post("/image")
-async def generate_image(request: GenerateRequest) -> Response:
+async def generate_image(
+    request: GenerateRequest,
+    allowed: Annotated[frozenset[CapabilityKey], Depends(get_allowed)],
+    accept: Annotated[str | None, Header()] = None,
+) -> Response:
     """Generate an image from a text prompt.
 
     Returns:
-        Generated PNG image
+        Generated image: JPEG if the Accept header prefers image/jpeg over
+        image/png, else PNG
     """
+    wants_jpeg = accept is not None and (
+        _quality(accept, "image/jpeg") > _quality(accept, "image/png")
+    )
+
     # Check capability
     try:
-        require_generate(request.model)
+        require_generate(request.model, allowed)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e)) from None
 
-    # Submit to GPU queue
-    async def do_generate():
-        return await generator.generate(
+    try:
+        # Batched with concurrent requests and run on the GPU queue
+        image = await generator.generate(
             prompt=request.prompt,
             negative_prompt=request.negative_prompt,
             width=request.width,
@@ -54,10 +94,14 @@ async def generate_image(request: GenerateRequest) -> Response:
             guidance=request.guidance,
             model=request.model,
         )
-
-    try:
-        result = await gpu_queue.submit(do_generate)
+        # Encode outside the GPU queue so the next job isn't held up by the encoder
+        if wants_jpeg:
+            result = await encode_jpeg(image)
+        else:
+            result = await encode_png(image)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e)) from None
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Generation failed: {e}") from None
 
-    return Response(content=result, media_type="image/png")
+    return Response(content=result, media_type="image/jpeg" if wants_jpeg else "image/png")
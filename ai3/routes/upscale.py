@@ -2,11 +2,12 @@
 
 from typing import Annotated
 
-from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
 from fastapi.responses import Response
 
-from services.capabilities import require_upscale
-from services.queue import gpu_queue
+from routes.deps import get_allowed
+from services.batcher import QueueFullError
+from services.capabilities import CapabilityKey, require_upscale
 from services.upscaler import upscaler
 
 router = APIRouter(prefix="/api")
@@ -15,6 +16,7 @@ router = APIRouter(prefix="/api")
 @router.post("/upscale")
 async def upscale(
     image: Annotated[UploadFile, File()],
+    allowed: Annotated[frozenset[CapabilityKey], Depends(get_allowed)],
     scale: Annotated[int, Form()] = 4,
     prompt: Annotated[str | None, Form()] = None,
     negative_prompt: Annotated[str | None, Form()] = None,
@@ -42,19 +44,22 @@ async def upscale(
 
     # Check capability
     try:
-        require_upscale(scale)
+        require_upscale(scale, allowed=allowed)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e)) from None
 
-    # Read image data
-    image_bytes = await image.read()
-
-    # Submit to GPU queue
-    async def do_upscale():
-        return await upscaler.upscale(image_bytes, scale=scale)
-
     try:
-        result = await gpu_queue.submit(do_upscale)
+        # Take a pending slot before decoding so an overloaded server rejects uploads
+        # up front. Decode then overlaps GPU work; only the (batched) model run holds
+        # a GPU queue slot, and encoding happens after both are released.
+        async with upscaler.reserve(scale):
+            decoded = await upscaler.decode(image.file)
+            output = await upscaler.upscale(decoded, scale=scale)
+        result = await upscaler.encode(output)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e)) from None
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upscaling failed: {e}") from None
 
@@ -1,5 +1,13 @@
-"""Services for AI operations."""
+"""Services for AI operations.
 
+Only the lightweight capability and queue API is re-exported here. Model services
+(captioner, generator, upscaler) are imported from their own modules, so importing
+any part of this package doesn't pull in torch and the model libraries.
+"""
+
+import os
+
+from services.batcher import QueueFullError
 from services.capabilities import (
     CapabilitiesResponse,
     Capability,
@@ -10,10 +18,23 @@ from services.capabilities import (
     has_capability,
     require_generate,
     require_upscale,
+    settings,
 )
-from services.generator import generator
-from services.queue import gpu_queue
-from services.upscaler import upscaler
+from services.queue import gpu_executor, gpu_queue
+
+# Allocator config per CUDA_ALLOCATOR setting. Must be set before torch initializes
+# CUDA; none of the modules imported above import torch at load time.
+# - native: expandable segments let the caching allocator grow and unmap segments
+#   instead of leaving fragmented blocks behind when one diffusion pipeline is swapped
+#   for another; capping split size keeps large blocks from being carved up.
+# - cudaMallocAsync: the driver's stream-ordered pool, which returns memory per block
+#   and handles varying shapes well, but frees are slower on older drivers and
+#   allocator snapshots (CUDA_MEMORY_SNAPSHOT_DIR) aren't supported.
+ALLOC_CONF = {
+    "native": "expandable_segments:True,max_split_size_mb:512",
+    "cudaMallocAsync": "backend:cudaMallocAsync",
+}
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", ALLOC_CONF[settings.cuda_allocator])
 
 __all__ = [
     "Capability",
@@ -25,7 +46,7 @@ __all__ = [
     "has_capability",
     "require_upscale",
     "require_generate",
+    "gpu_executor",
     "gpu_queue",
-    "upscaler",
-    "generator",
+    "QueueFullError",
 ]
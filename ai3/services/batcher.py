@@ -0,0 +1,141 @@
+"""Dynamic request batching for GPU operations."""
+
+import asyncio
+import contextlib
+import logging
+from collections.abc import AsyncIterator, Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+# Requests that may be in flight per key (from before their CPU decode until their
+# result returns), and how long a caller waits for a slot before being rejected
+MAX_PENDING = 16
+SUBMIT_TIMEOUT_S = 30
+
+
+class QueueFullError(RuntimeError):
+    """A batcher's key stayed full for longer than the submit timeout."""
+
+
+class Batcher[T, R]:
+    """Coalesce concurrent requests into batched calls.
+
+    Items submitted under the same key are collected for up to ``max_wait_ms``
+    (or until ``max_batch_size`` items are pending) and handed to the batch
+    function in a single call. Each key gets its own queue and consumer, so
+    only compatible items are ever batched together. The batch function may
+    return an exception in place of an item's result to fail only that item.
+
+    Callers take a slot with reserve() before doing any preprocessing, so at most
+    ``max_pending`` requests per key hold decoded inputs at once. Once a key is
+    full, reserve() waits up to ``submit_timeout_s`` for a slot, then raises
+    QueueFullError.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[Hashable, list[T]], Awaitable[list[R]]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 20,
+        max_pending: int = MAX_PENDING,
+        submit_timeout_s: float = SUBMIT_TIMEOUT_S,
+    ):
+        self._fn = fn
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._max_pending = max_pending
+        self._submit_timeout = submit_timeout_s
+        self._queues: dict[Hashable, asyncio.Queue] = {}
+        self._slots: dict[Hashable, asyncio.Semaphore] = {}
+        self._workers: dict[Hashable, asyncio.Task] = {}
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, key: Hashable) -> AsyncIterator[None]:
+        """Hold one of the key's pending slots for the duration of the block."""
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots[key] = asyncio.Semaphore(self._max_pending)
+
+        try:
+            await asyncio.wait_for(slots.acquire(), self._submit_timeout)
+        except TimeoutError:
+            raise QueueFullError(
+                f"Too many pending requests ({self._max_pending}) for {self._submit_timeout:g}s"
+            ) from None
+        try:
+            yield
+        finally:
+            slots.release()
+
+    async def submit(self, key: Hashable, item: T) -> R:
+        """Submit an item and wait for its result.
+
+        Call this inside reserve() for the same key; submit() itself doesn't
+        bound how many items wait.
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = asyncio.Queue()
+            self._workers[key] = asyncio.create_task(self._worker(key, queue))
+
+        future: asyncio.Future[R] = asyncio.get_running_loop().create_future()
+        await queue.put((item, future))
+        return await future
+
+    async def stop(self):
+        """Stop all batch consumers."""
+        for task in self._workers.values():
+            task.cancel()
+        for task in self._workers.values():
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._workers.clear()
+        self._queues.clear()
+        self._slots.clear()
+
+    async def _collect(self, queue: asyncio.Queue) -> list[tuple[T, asyncio.Future[R]]]:
+        """Wait for the first item, then drain until the batch is full or time is up."""
+        loop = asyncio.get_running_loop()
+        batch = [await queue.get()]
+        deadline = loop.time() + self._max_wait
+
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except TimeoutError:
+                break
+
+        return batch
+
+    async def _worker(self, key: Hashable, queue: asyncio.Queue):
+        """Process batches for a single key."""
+        while True:
+            batch = await self._collect(queue)
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+
+            if len(batch) > 1:
+                logger.debug(f"Running batch of {len(batch)} for {key}")
+
+            try:
+                results = await self._fn(key, items)
+                if len(results) != len(items):
+                    raise RuntimeError(
+                        f"Batch returned {len(results)} results for {len(items)} items"
+                    )
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for future, result in zip(futures, results, strict=True):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
@@ -1,6 +1,7 @@
 """GPU capability detection and tier logic."""
 
 import logging
+from functools import lru_cache
 from typing import Literal, TypedDict
 
 from pydantic_settings import BaseSettings
@@ -12,12 +13,22 @@ class Settings(BaseSettings):
     """Server settings from environment variables."""
 
     gpu_memory_gb: float | None = None  # None = auto-detect
+    caption_quantize: Literal["none", "8bit", "4bit"] = "none"  # bitsandbytes, CUDA only
+    generator_quantize: Literal["none", "fp8", "nvfp4"] = "none"  # torchao, needs sm89+/sm100+
+    compile_pipelines: bool = True  # torch.compile resident diffusion pipelines
+    sdxl_tiny_vae: bool = False  # decode SDXL with TAESD (faster, slightly softer)
+    cuda_memory_snapshot_dir: str | None = None  # dump allocator snapshots on model unload
+    cuda_allocator: Literal["native", "cudaMallocAsync"] = "native"  # PyTorch CUDA allocator
+    cuda_memory_fraction: float | None = None  # cap allocator to this share of VRAM
 
     model_config = {"env_prefix": ""}
 
 
 settings = Settings()
 
+# Fraction of the fp16 VRAM tier that Florence-2 needs when quantized
+CAPTION_VRAM_SCALE = {"none": 1.0, "8bit": 0.75, "4bit": 0.5}
+
 
 class UpscaleCapability(TypedDict):
     """Upscale capability record."""
@@ -43,6 +54,9 @@ class CaptionCapability(TypedDict):
 
 Capability = UpscaleCapability | ImageCapability | CaptionCapability
 
+# (kind, model, scale) lookup key for a capability record
+CapabilityKey = tuple[str, str | None, int | None]
+
 
 class CapabilitiesResponse(TypedDict):
     """Full capabilities response."""
@@ -52,6 +66,7 @@ class CapabilitiesResponse(TypedDict):
     gpu_memory_gb: float
 
 
+@lru_cache(maxsize=1)
 def get_gpu_memory() -> float:
     """Get GPU memory in GB (from env or auto-detect)."""
     if settings.gpu_memory_gb is not None:
@@ -65,6 +80,7 @@ def get_gpu_memory() -> float:
     return 0.0
 
 
+@lru_cache(maxsize=1)
 def get_device() -> Literal["cuda", "cpu"]:
     """Get compute device (cuda or cpu)."""
     import torch
@@ -75,8 +91,12 @@ def get_device() -> Literal["cuda", "cpu"]:
     return "cpu"
 
 
+@lru_cache(maxsize=1)
 def get_capabilities() -> CapabilitiesResponse:
-    """Return available capabilities based on GPU memory."""
+    """Return available capabilities based on GPU memory.
+
+    Detected once per process; the result is shared, so don't mutate it.
+    """
     mem = get_gpu_memory()
     device = get_device()
 
@@ -100,11 +120,8 @@ def get_capabilities() -> CapabilitiesResponse:
     # GPU mode: based on VRAM
     if mem >= 4:
         capabilities.append({"kind": "upscale", "model": "realesrgan-x2plus", "scale": 2})
-        capabilities.append({"kind": "caption", "model": "blip2"})
-        capabilities.append({"kind": "caption", "model": "florence2-base"})
     if mem >= 6:
         capabilities.append({"kind": "upscale", "model": "realesrgan-x4plus", "scale": 4})
-        capabilities.append({"kind": "caption", "model": "florence2-large"})
     if mem >= 8:
         capabilities.append({"kind": "image", "model": "sdxl"})
     if mem >= 12:
@@ -116,6 +133,16 @@ def get_capabilities() -> CapabilitiesResponse:
         # FLUX.2-dev is a 32B model, needs more VRAM
         capabilities.append({"kind": "image", "model": "flux2"})
 
+    # Caption models: quantized weights lower the Florence-2 tiers (e.g. 4-bit large at
+    # 3 GB). BLIP-2's OPT-2.7b language model doesn't fit below its own tier either way.
+    if mem >= 4:
+        capabilities.append({"kind": "caption", "model": "blip2"})
+    caption_scale = CAPTION_VRAM_SCALE[settings.caption_quantize]
+    if mem >= 4 * caption_scale:
+        capabilities.append({"kind": "caption", "model": "florence2-base"})
+    if mem >= 6 * caption_scale:
+        capabilities.append({"kind": "caption", "model": "florence2-large"})
+
     return {
         "capabilities": capabilities,
         "device": "cuda",
@@ -123,22 +150,45 @@ def get_capabilities() -> CapabilitiesResponse:
     }
 
 
-def has_capability(kind: str, **kwargs) -> bool:
-    """Check if a capability is available."""
-    caps = get_capabilities()
-    for cap in caps["capabilities"]:
-        if cap["kind"] != kind:
-            continue
-        if all(cap.get(k) == v for k, v in kwargs.items()):
-            return True
-    return False
-
-
-def require_upscale(scale: int, model: str = "realesrgan-x4plus") -> None:
+@lru_cache(maxsize=1)
+def capability_keys() -> frozenset[CapabilityKey]:
+    """Return the set of available (kind, model, scale) keys."""
+    return frozenset(
+        (cap["kind"], cap.get("model"), cap.get("scale"))
+        for cap in get_capabilities()["capabilities"]
+    )
+
+
+def has_capability(
+    kind: str,
+    model: str | None = None,
+    scale: int | None = None,
+    allowed: frozenset[CapabilityKey] | None = None,
+) -> bool:
+    """Check if a capability is available (in ``allowed``, or the detected set).
+
+    ``model`` and ``scale`` left as None match any value, so e.g.
+    ``has_capability("image")`` is true if any generation model is available.
+    """
+    if allowed is None:
+        allowed = capability_keys()
+    if model is not None and scale is not None:
+        return (kind, model, scale) in allowed
+    return any(
+        k == kind and (model is None or m == model) and (scale is None or s == scale)
+        for k, m, s in allowed
+    )
+
+
+def require_upscale(
+    scale: int,
+    model: str = "realesrgan-x4plus",
+    allowed: frozenset[CapabilityKey] | None = None,
+) -> None:
     """Raise ValueError if upscale capability unavailable."""
     if scale == 2:
         model = "realesrgan-x2plus"
-    if not has_capability("upscale", model=model, scale=scale):
+    if not has_capability("upscale", model=model, scale=scale, allowed=allowed):
         caps = get_capabilities()
         raise ValueError(
             f"Upscale {scale}x with {model} not available. "
@@ -146,9 +196,9 @@ def require_upscale(scale: int, model: str = "realesrgan-x4plus") -> None:
         )
 
 
-def require_generate(model: str) -> None:
+def require_generate(model: str, allowed: frozenset[CapabilityKey] | None = None) -> None:
     """Raise ValueError if generation model unavailable."""
-    if not has_capability("image", model=model):
+    if not has_capability("image", model=model, allowed=allowed):
         caps = get_capabilities()
         raise ValueError(
             f"Image generation with {model} not available. "
@@ -156,9 +206,9 @@ def require_generate(model: str) -> None:
         )
 
 
-def require_caption(model: str) -> None:
+def require_caption(model: str, allowed: frozenset[CapabilityKey] | None = None) -> None:
     """Raise ValueError if caption model unavailable."""
-    if not has_capability("caption", model=model):
+    if not has_capability("caption", model=model, allowed=allowed):
         caps = get_capabilities()
         raise ValueError(
             f"Captioning with {model} not available. "
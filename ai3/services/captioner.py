@@ -1,13 +1,19 @@
 """Image captioning service using BLIP-2 and Florence-2."""
 
 import asyncio
-import io
 import logging
-from typing import Literal
+import re
+from collections.abc import Hashable
+from typing import TYPE_CHECKING, BinaryIO, Literal
 
 from PIL import Image
 
-from services.capabilities import get_device
+from services.batcher import Batcher
+from services.capabilities import get_device, settings
+from services.queue import cpu_executor, gpu_executor, gpu_queue
+
+if TYPE_CHECKING:
+    import torch
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +26,23 @@ MODEL_IDS = {
 
 CaptionModel = Literal["blip2", "florence2-base", "florence2-large"]
 
+# Dynamic batching: concurrent requests within the wait window share one generate() call
+MAX_BATCH_SIZE = 8
+MAX_WAIT_MS = 20
+
+# Florence-2 task used for captioning
+FLORENCE_TASK = "<MORE_DETAILED_CAPTION>"
+
+# Caption tasks are "pure text" in Florence-2's post-processor, which only strips
+# these tokens; one precompiled pattern replaces its per-image parser
+FLORENCE_SPECIAL_TOKENS = re.compile(r"</?s>|<pad>")
+
+# Generation settings. Captions end long before these limits; greedy decoding is the
+# default and beam search is reserved for detailed requests.
+BLIP2_MAX_NEW_TOKENS = 50
+FLORENCE_GENERATE_ARGS = {"max_new_tokens": 256, "num_beams": 1, "do_sample": False}
+FLORENCE_DETAIL_GENERATE_ARGS = {"max_new_tokens": 1024, "num_beams": 3, "early_stopping": True}
+
 
 class Captioner:
     """Multi-model image captioner supporting BLIP-2 and Florence-2."""
@@ -30,8 +53,18 @@ class Captioner:
         self._florence_model = None
         self._florence_processor = None
         self._florence_variant: str | None = None
+        # Preallocated pixel buffers and constant prompt tensors (set on load)
+        self._blip2_pixels = None
+        self._blip2_prompt: dict = {}
+        self._florence_pixels = None
+        self._florence_prompt: dict = {}
         self._device = None
         self._loaded_models: list[str] = []
+        self._batcher: Batcher[torch.Tensor, str] = Batcher(
+            self._run_batch,
+            max_batch_size=MAX_BATCH_SIZE,
+            max_wait_ms=MAX_WAIT_MS,
+        )
 
     async def load(self, models: list[str]):
         """Load caption models.
@@ -44,8 +77,10 @@ class Captioner:
 
         loop = asyncio.get_event_loop()
 
+        quantize = settings.caption_quantize
+
         if "blip2" in models:
-            await loop.run_in_executor(None, self._load_blip2)
+            await loop.run_in_executor(gpu_executor, self._load_blip2, quantize)
             self._loaded_models.append("blip2")
 
         # Load Florence (prefer large if requested, otherwise base)
@@ -56,7 +91,9 @@ class Captioner:
             florence_to_load = "florence2-base"
 
         if florence_to_load:
-            await loop.run_in_executor(None, self._load_florence, florence_to_load)
+            await loop.run_in_executor(
+                gpu_executor, self._load_florence, florence_to_load, quantize
+            )
             # Florence can handle both variants once loaded (just use largest available)
             if florence_to_load == "florence2-large":
                 self._loaded_models.append("florence2-large")
@@ -66,53 +103,133 @@ class Captioner:
 
         logger.info(f"Caption models loaded: {self._loaded_models}")
 
-    def _load_blip2(self):
+    def _quantization_config(self, quantize: str):
+        """Build a bitsandbytes config for the requested quantization, if any."""
+        if quantize == "none":
+            return None
+        if self._device != "cuda":
+            logger.warning(f"Caption quantization ({quantize}) requires CUDA - loading fp32")
+            return None
+
+        import torch
+        from transformers import BitsAndBytesConfig
+
+        if quantize == "8bit":
+            return BitsAndBytesConfig(load_in_8bit=True)
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_quant_type="nf4",
+        )
+
+    def _load_blip2(self, quantize: str = "none"):
         """Load BLIP-2 model (blocking)."""
         import torch
         from transformers import Blip2ForConditionalGeneration, Blip2Processor
 
-        logger.info("Loading BLIP-2 model...")
+        logger.info(f"Loading BLIP-2 model (quantize={quantize})...")
 
+        quantization_config = self._quantization_config(quantize)
         self._blip2_processor = Blip2Processor.from_pretrained(MODEL_IDS["blip2"])
         self._blip2_model = Blip2ForConditionalGeneration.from_pretrained(
             MODEL_IDS["blip2"],
             torch_dtype=torch.float16 if self._device == "cuda" else torch.float32,
+            quantization_config=quantization_config,
+            device_map=self._device if quantization_config else None,
         )
-        self._blip2_model = self._blip2_model.to(self._device)
+        # Quantized models are placed by device_map and can't be moved
+        if quantization_config is None:
+            self._blip2_model = self._blip2_model.to(self._device)
         self._blip2_model.eval()
+        self._blip2_pixels, self._blip2_prompt = self._preallocate(
+            self._blip2_processor, self._blip2_model.dtype
+        )
 
         logger.info("BLIP-2 model loaded")
 
-    def _load_florence(self, variant: str):
+    def _load_florence(self, variant: str, quantize: str = "none"):
         """Load Florence-2 model (blocking)."""
         import torch
         from transformers import AutoModelForCausalLM, AutoProcessor
 
-        logger.info(f"Loading Florence-2 ({variant}) model...")
+        logger.info(f"Loading Florence-2 ({variant}) model (quantize={quantize})...")
 
         model_id = MODEL_IDS[variant]
+        quantization_config = self._quantization_config(quantize)
         self._florence_processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
         self._florence_model = AutoModelForCausalLM.from_pretrained(
             model_id,
             torch_dtype=torch.float16 if self._device == "cuda" else torch.float32,
             trust_remote_code=True,
+            quantization_config=quantization_config,
+            device_map=self._device if quantization_config else None,
         )
-        self._florence_model = self._florence_model.to(self._device)
+        if quantization_config is None:
+            self._florence_model = self._florence_model.to(self._device)
         self._florence_model.eval()
+        self._florence_pixels, self._florence_prompt = self._preallocate(
+            self._florence_processor, self._florence_model.dtype, text=FLORENCE_TASK
+        )
+        self._graph_florence_encoder()
         self._florence_variant = variant
 
         logger.info(f"Florence-2 ({variant}) model loaded")
 
+    def _preallocate(self, processor, dtype, text: str | None = None):
+        """Allocate a max-batch pixel buffer and move the constant prompt to the device.
+
+        The processor resizes every image to the model's canonical resolution, so one
+        probe run gives the fixed pixel shape. The prompt tokens never change, so they
+        are kept on the device and expanded per batch instead of re-tokenized.
+        """
+        from services.staging import StagingBuffer
+
+        probe = processor(
+            text=[text] if text else None,
+            images=[Image.new("RGB", (64, 64))],
+            return_tensors="pt",
+        )
+        pixel_shape = probe["pixel_values"].shape[1:]
+        pixels = StagingBuffer((MAX_BATCH_SIZE, *pixel_shape), dtype, self._device)
+        prompt = {k: v.to(self._device) for k, v in probe.items() if k != "pixel_values"}
+        return pixels, prompt
+
+    def _graph_florence_encoder(self):
+        """Replay the Florence-2 image encoder from CUDA graphs.
+
+        Pixel inputs always have the processor's fixed resolution, so each batch size
+        is a fixed shape and the vision tower can be captured once and replayed.
+        """
+        if self._device != "cuda" or not hasattr(self._florence_model, "_encode_image"):
+            return
+
+        from services.cuda_graphs import GraphedCallable
+
+        pixel_shape = self._florence_pixels.shape[1:]
+        self._florence_model._encode_image = GraphedCallable(
+            self._florence_model._encode_image,
+            shapes=[(batch_size, *pixel_shape) for batch_size in range(1, MAX_BATCH_SIZE + 1)],
+        )
+
+    async def stop(self):
+        """Stop the batching workers."""
+        await self._batcher.stop()
+
     async def caption(
         self,
-        image_bytes: bytes,
+        image: BinaryIO,
         model: CaptionModel = "florence2-base",
+        detail: bool = False,
     ) -> str:
         """Generate a caption for an image.
 
+        Concurrent calls for the same model are coalesced into a single batched
+        generate() call, which is then run through the GPU queue.
+
         Args:
-            image_bytes: Input image as bytes
+            image: Input image file (e.g. the upload's spooled file, read in place)
             model: Model to use for captioning
+            detail: Use beam search for a longer, more thorough caption (Florence-2 only)
 
         Returns:
             Generated caption string
@@ -120,73 +237,104 @@ class Captioner:
         if model not in self._loaded_models:
             raise RuntimeError(f"Model {model} not loaded. Available: {self._loaded_models}")
 
+        # Only requests with the same generation settings can share a batch. The
+        # pending slot is taken before decoding, so an overloaded model rejects new
+        # uploads instead of piling up decoded images.
+        key = (model, detail)
+        async with self._batcher.reserve(key):
+            # Decode and preprocess each upload on the CPU pool before batching. It
+            # overlaps the GPU work of earlier batches, and a file that isn't a valid
+            # image fails only its own request.
+            loop = asyncio.get_event_loop()
+            pixel_values = await loop.run_in_executor(
+                cpu_executor, self._preprocess_sync, image, model
+            )
+            return await self._batcher.submit(key, pixel_values)
+
+    async def _run_batch(self, key: Hashable, batch: list["torch.Tensor"]) -> list[str]:
+        """Caption a batch of images on the GPU queue."""
+        import torch
+
+        model, detail = key
+
+        # Stack before taking a queue slot, keeping the copy off the GPU thread
         loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            self._caption_sync,
-            image_bytes,
-            model,
-        )
-        return result
+        pixel_values = await loop.run_in_executor(cpu_executor, torch.cat, batch)
 
-    def _caption_sync(self, image_bytes: bytes, model: str) -> str:
-        """Synchronous captioning operation."""
-        # Load image
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        async def do_caption():
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                gpu_executor, self._caption_sync, pixel_values, model, detail
+            )
 
+        return await gpu_queue.submit(do_caption, key=f"caption:{model}")
+
+    def _decode_sync(self, file: BinaryIO, model: str) -> Image.Image:
+        """Decode an upload to RGB, straight from the file without buffering it first."""
+        pixels = self._blip2_pixels if model == "blip2" else self._florence_pixels
+        height, width = pixels.shape[-2:]
+
+        file.seek(0)
+        try:
+            image = Image.open(file)
+            # The processor downsizes to the model resolution anyway, so let libjpeg
+            # decode JPEGs at a reduced DCT scale (no-op for other formats)
+            image.draft("RGB", (width, height))
+            return image.convert("RGB")
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ValueError(f"Failed to decode image: {e}") from None
+
+    def _preprocess_sync(self, file: BinaryIO, model: str) -> "torch.Tensor":
+        """Decode an upload into the model's pixel values (batch of one) on the CPU."""
+        processor = self._blip2_processor if model == "blip2" else self._florence_processor
+        image = self._decode_sync(file, model)
+        return processor.image_processor([image], return_tensors="pt")["pixel_values"]
+
+    def _caption_sync(self, pixel_values, model: str, detail: bool) -> list[str]:
+        """Synchronous captioning operation."""
         if model == "blip2":
-            return self._caption_blip2(image)
+            return self._caption_blip2(pixel_values)
         elif model in ("florence2-base", "florence2-large"):
-            return self._caption_florence(image)
+            return self._caption_florence(pixel_values, detail)
         else:
             raise ValueError(f"Unknown model: {model}")
 
-    def _caption_blip2(self, image: Image.Image) -> str:
-        """Generate caption using BLIP-2."""
+    def _caption_blip2(self, pixel_values) -> list[str]:
+        """Generate captions using BLIP-2."""
         import torch
 
-        inputs = self._blip2_processor(images=image, return_tensors="pt").to(
-            self._device, torch.float16 if self._device == "cuda" else torch.float32
-        )
+        batch_size = len(pixel_values)
+        pixel_values = self._blip2_pixels.stage(pixel_values)
+        prompt = {k: v.expand(batch_size, -1) for k, v in self._blip2_prompt.items()}
 
-        with torch.no_grad():
-            generated_ids = self._blip2_model.generate(**inputs, max_new_tokens=100)
+        with torch.inference_mode():
+            generated_ids = self._blip2_model.generate(
+                pixel_values=pixel_values, **prompt, max_new_tokens=BLIP2_MAX_NEW_TOKENS
+            )
 
-        caption = self._blip2_processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        return caption.strip()
+        captions = self._blip2_processor.batch_decode(generated_ids, skip_special_tokens=True)
+        return [caption.strip() for caption in captions]
 
-    def _caption_florence(self, image: Image.Image) -> str:
-        """Generate caption using Florence-2."""
+    def _caption_florence(self, pixel_values, detail: bool = False) -> list[str]:
+        """Generate captions using Florence-2."""
         import torch
 
-        # Use detailed caption task
-        task_prompt = "<MORE_DETAILED_CAPTION>"
-
-        inputs = self._florence_processor(text=task_prompt, images=image, return_tensors="pt").to(
-            self._device, torch.float16 if self._device == "cuda" else torch.float32
-        )
+        batch_size = len(pixel_values)
+        pixel_values = self._florence_pixels.stage(pixel_values)
+        input_ids = self._florence_prompt["input_ids"].expand(batch_size, -1)
 
-        with torch.no_grad():
+        generate_args = FLORENCE_DETAIL_GENERATE_ARGS if detail else FLORENCE_GENERATE_ARGS
+        with torch.inference_mode():
             generated_ids = self._florence_model.generate(
-                input_ids=inputs["input_ids"],
-                pixel_values=inputs["pixel_values"],
-                max_new_tokens=1024,
-                num_beams=3,
+                input_ids=input_ids,
+                pixel_values=pixel_values,
+                **generate_args,
             )
 
-        generated_text = self._florence_processor.batch_decode(
+        generated_texts = self._florence_processor.batch_decode(
             generated_ids, skip_special_tokens=False
-        )[0]
-
-        # Parse the output
-        parsed = self._florence_processor.post_process_generation(
-            generated_text,
-            task=task_prompt,
-            image_size=(image.width, image.height),
         )
-
-        caption = parsed.get(task_prompt, generated_text)
-        return caption.strip()
+        return [FLORENCE_SPECIAL_TOKENS.sub("", text).strip() for text in generated_texts]
 
 
 captioner = Captioner()
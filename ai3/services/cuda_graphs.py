@@ -0,0 +1,73 @@
+"""CUDA graph capture for fixed-shape model calls."""
+
+import logging
+from collections.abc import Callable, Iterable
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class GraphedCallable:
+    """Replay a single-tensor function from CUDA graphs, one per input shape.
+
+    Graphs are captured lazily the first time an allowed shape is seen and then
+    replayed, removing per-kernel launch overhead. Shapes outside ``shapes`` run
+    eagerly. If capture fails, the function falls back to eager mode for good.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[torch.Tensor], torch.Tensor],
+        shapes: Iterable[tuple[int, ...]],
+        warmup_iters: int = 2,
+    ):
+        self._fn = fn
+        self._shapes = {tuple(shape) for shape in shapes}
+        self._warmup_iters = warmup_iters
+        self._graphs: dict[
+            tuple[int, ...], tuple[torch.cuda.CUDAGraph, torch.Tensor, torch.Tensor]
+        ] = {}
+        # Graphs never replay concurrently and outputs are cloned, so one pool is safe
+        self._pool = torch.cuda.graph_pool_handle()
+        self._disabled = False
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        shape = tuple(x.shape)
+        if self._disabled or shape not in self._shapes:
+            return self._fn(x)
+
+        entry = self._graphs.get(shape)
+        if entry is None:
+            try:
+                entry = self._graphs[shape] = self._capture(x)
+            except Exception as e:
+                logger.warning(f"CUDA graph capture failed, running eagerly: {e}")
+                self._disabled = True
+                return self._fn(x)
+
+        graph, static_in, static_out = entry
+        static_in.copy_(x)
+        graph.replay()
+        return static_out.clone()
+
+    def _capture(self, x: torch.Tensor):
+        """Warm up on a side stream, then capture a graph for this input shape."""
+        static_in = x.clone()
+
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self._warmup_iters):
+                self._fn(static_in)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # Captures happen lazily while the copy thread may be allocating or syncing on
+        # its own stream; thread_local mode keeps those calls from invalidating the
+        # capture, while still catching unsafe calls made from this thread
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self._pool, capture_error_mode="thread_local"):
+            static_out = self._fn(static_in)
+
+        logger.info(f"Captured CUDA graph for input shape {tuple(x.shape)}")
+        return graph, static_in, static_out
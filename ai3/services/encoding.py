@@ -0,0 +1,98 @@
+"""Output image encoding on a dedicated CPU thread pool."""
+
+import asyncio
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+import numpy as np
+from PIL import Image
+
+from services.queue import copy_executor
+
+try:
+    # libspng filters with SIMD and is several times faster than PIL's encoder
+    import pyspng
+except ImportError:
+    pyspng = None
+
+try:
+    # Fallback for platforms without pyspng wheels; its PNG codec deflates with
+    # zlib-ng/libdeflate rather than stock zlib
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+if TYPE_CHECKING:
+    import torch
+
+# PNG encoding is pure CPU work; keep it off the GPU queue so the next job can start
+png_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="png")
+
+# zlib level 1 is several times faster than the default and still lossless
+PNG_COMPRESS_LEVEL = 1
+
+JPEG_QUALITY = 95
+
+_local = threading.local()
+
+
+def _thread_buffer() -> io.BytesIO:
+    """Per-thread output buffer, reused so each encode doesn't grow a fresh one."""
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None:
+        buffer = _local.buffer = io.BytesIO()
+    buffer.seek(0)
+    return buffer
+
+
+def encode_png_array(array: np.ndarray) -> bytes:
+    """Encode a uint8 HWC (RGB or RGBA) or HW (gray) array as PNG (blocking).
+
+    Uses libspng through pyspng when installed, then imagecodecs, otherwise PIL.
+    """
+    array = np.ascontiguousarray(array)
+    if pyspng is not None:
+        return pyspng.encode(
+            array, progressive=pyspng.ProgressiveMode.NONE, compress_level=PNG_COMPRESS_LEVEL
+        )
+    if imagecodecs is not None:
+        return imagecodecs.png_encode(array, level=PNG_COMPRESS_LEVEL)
+
+    buffer = _thread_buffer()
+    pil_image = Image.fromarray(array)
+    pil_image.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL, optimize=False)
+    size = buffer.tell()
+    # Copy out only this image's bytes; the buffer may hold a larger previous one
+    with buffer.getbuffer() as view:
+        return bytes(view[:size])
+
+
+def _encode_png_sync(image: "torch.Tensor") -> bytes:
+    """Encode a uint8 CHW CPU tensor as PNG (blocking)."""
+    return encode_png_array(image.permute(1, 2, 0).numpy())
+
+
+def _encode_jpeg_sync(image: "torch.Tensor") -> bytes:
+    """Encode a uint8 CHW tensor as JPEG (blocking); CUDA tensors use nvJPEG."""
+    from torchvision.io import encode_jpeg
+
+    return encode_jpeg(image, quality=JPEG_QUALITY).cpu().numpy().tobytes()
+
+
+async def encode_png(image: "torch.Tensor") -> bytes:
+    """Encode a uint8 CHW image tensor as PNG on the encoder thread pool."""
+    loop = asyncio.get_event_loop()
+    if image.is_cuda:
+        # Copied back on the copy thread, not the GPU thread, which may already be
+        # running another model's task
+        image = await loop.run_in_executor(copy_executor, image.cpu)
+    return await loop.run_in_executor(png_executor, _encode_png_sync, image)
+
+
+async def encode_jpeg(image: "torch.Tensor") -> bytes:
+    """Encode a uint8 CHW image tensor as JPEG, on the GPU if it lives there."""
+    loop = asyncio.get_event_loop()
+    executor = copy_executor if image.is_cuda else png_executor
+    return await loop.run_in_executor(executor, _encode_jpeg_sync, image)
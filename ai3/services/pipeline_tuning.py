@@ -0,0 +1,81 @@
+"""torchao quantization and torch.compile for resident diffusion pipelines."""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# torch.compile mode for each denoiser. max-autotune benchmarks Triton/cuBLAS
+# variants per kernel, which pays off for the convolution-heavy SDXL UNet; the
+# transformers gain most from the CUDA graphs that reduce-overhead captures.
+COMPILE_MODE = {
+    "sdxl": "max-autotune",
+    "flux": "reduce-overhead",
+    "flux2": "reduce-overhead",
+    "zimage-turbo": "reduce-overhead",
+}
+
+# Minimum CUDA compute capability for each torchao weight format: FP8 tensor
+# cores arrived with Ada/Hopper, FP4 with Blackwell
+QUANT_MIN_CAPABILITY = {"fp8": (8, 9), "nvfp4": (10, 0)}
+
+# Layers left in bf16 when quantizing: input/timestep embeddings and output projections
+QUANT_SKIP_LAYERS = ("embed", "proj_out", "norm_out", "conv_in", "conv_out")
+
+
+def _denoiser_name(pipe) -> str:
+    """Attribute holding the pipeline's denoiser."""
+    return "unet" if hasattr(pipe, "unet") else "transformer"
+
+
+def quantize_pipeline(pipe, model: str, quant: str):
+    """Quantize the denoiser's linear layers with torchao (blocking).
+
+    Keeps bf16 when the GPU lacks the format.
+    """
+    import torch
+
+    capability = torch.cuda.get_device_capability()
+    if capability < QUANT_MIN_CAPABILITY[quant]:
+        logger.warning(f"GPU compute capability {capability} can't run {quant}, keeping bf16")
+        return
+
+    from torchao.quantization import quantize_
+
+    if quant == "fp8":
+        from torchao.quantization import Float8DynamicActivationFloat8WeightConfig, PerRow
+
+        config = Float8DynamicActivationFloat8WeightConfig(granularity=PerRow())
+    else:
+        from torchao.prototype.mx_formats import NVFP4InferenceConfig
+
+        config = NVFP4InferenceConfig()
+
+    def quantizable(module: torch.nn.Module, fqn: str) -> bool:
+        # Tensor-core kernels need both matmul dims to be multiples of 16
+        return (
+            isinstance(module, torch.nn.Linear)
+            and not any(part in fqn for part in QUANT_SKIP_LAYERS)
+            and module.in_features % 16 == 0
+            and module.out_features % 16 == 0
+        )
+
+    name = _denoiser_name(pipe)
+    logger.info(f"Quantizing {model} {name} to {quant}...")
+    quantize_(getattr(pipe, name), config, filter_fn=quantizable)
+
+
+def compile_pipeline(pipe, model: str):
+    """Compile the denoiser and VAE decoder, then warm them up so Inductor runs
+    at load, not on the first request (blocking).
+    """
+    import torch
+
+    mode = COMPILE_MODE[model]
+    name = _denoiser_name(pipe)
+    logger.info(f"Compiling {model} {name} ({mode})...")
+    setattr(pipe, name, torch.compile(getattr(pipe, name), mode=mode, fullgraph=False))
+    # The decode runs once per image at full resolution, so it's worth compiling too
+    pipe.vae.decode = torch.compile(pipe.vae.decode, fullgraph=False)
+
+    with torch.inference_mode():
+        pipe(prompt="warmup", width=1024, height=1024, num_inference_steps=1)
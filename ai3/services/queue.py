@@ -4,19 +4,114 @@ import asyncio
 import contextlib
 import logging
 from collections.abc import Callable, Coroutine
+from concurrent.futures import ThreadPoolExecutor
 from typing import TypeVar
 
+from services.capabilities import settings
+
 logger = logging.getLogger(__name__)
 
 T = TypeVar("T")
 
 
+def _init_gpu_thread():
+    """Give a GPU worker thread its own CUDA stream."""
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.set_stream(torch.cuda.Stream())
+    except Exception:
+        pass
+
+
+def _set_memory_fraction(fraction: float):
+    """Cap how much of the GPU the caching allocator may claim."""
+    import torch
+
+    if torch.cuda.is_available():
+        torch.cuda.set_per_process_memory_fraction(fraction)
+        logger.info(f"Limited CUDA allocator to {fraction:.0%} of device memory")
+
+
+def _init_model_thread():
+    """Set up the model thread, capping the allocator before any model is loaded."""
+    _init_gpu_thread()
+    if settings.cuda_memory_fraction is not None:
+        _set_memory_fraction(settings.cuda_memory_fraction)
+
+
+# All blocking model work (loads included) runs on this single thread, so every CUDA
+# call comes from one thread and one stream instead of interleaving across the default
+# pool, and its initializer runs before the first model touches the GPU.
+gpu_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="gpu", initializer=_init_model_thread
+)
+
+# Finished outputs are copied back to the host (or JPEG-encoded on the GPU) on their
+# own thread and stream, so a response never waits behind another model's task
+copy_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="copy", initializer=_init_gpu_thread
+)
+
+# Request preprocessing (decoding uploads, building input tensors) runs here before a
+# task is queued, so it overlaps the GPU thread's work on earlier requests
+cpu_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cpu")
+
+
+def _release_cache():
+    """Return cached, unused blocks to the driver."""
+    import torch
+
+    reserved = torch.cuda.memory_reserved()
+    torch.cuda.empty_cache()
+    freed = (reserved - torch.cuda.memory_reserved()) / 1024**3
+    logger.info(f"Released {freed:.1f} GB of cached GPU memory")
+
+
+# Cached-but-unused memory (reserved - allocated) that counts as fragmentation,
+# and how many tasks in a row must see it before the cache is released
+FRAGMENTATION_THRESHOLD_BYTES = 4 * 1024**3
+FRAGMENTATION_TASKS = 3
+
+# Drain the GPU thread's stream every this many tasks so queued kernels (and the
+# memory they hold) can't run arbitrarily far ahead of completed work
+SYNC_EVERY = 8
+
+
+def _synchronize():
+    """Wait for all queued work on the GPU thread's stream."""
+    import torch
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def _is_oom(error: Exception) -> bool:
+    """Whether an exception is a CUDA out-of-memory error."""
+    try:
+        import torch
+
+        return isinstance(error, torch.OutOfMemoryError)
+    except ImportError:
+        return False
+
+
 class GPUQueue:
-    """Queue for GPU operations - ensures only one GPU task runs at a time."""
+    """Queue for GPU operations, one task at a time per model key.
+
+    Each key (e.g. "caption:blip2") runs one task at a time, in submission order,
+    so work for one model can't pile up kernels on the GPU. Keys wait for their
+    own slot independently, so a backlog for one model doesn't hold up the others.
+    """
 
     def __init__(self):
         self._queue: asyncio.Queue = asyncio.Queue()
         self._worker_task: asyncio.Task | None = None
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._running: set[asyncio.Task] = set()
+        self._fragmented_tasks = 0
+        self._completed = 0
 
     async def start(self):
         """Start the queue worker."""
@@ -31,36 +126,82 @@ class GPUQueue:
                 await self._worker_task
             logger.info("GPU queue worker stopped")
 
+    def _lock(self, key: str) -> asyncio.Lock:
+        """Get the lock for a key, creating it on first use."""
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        return self._locks[key]
+
     async def _worker(self):
-        """Process queued GPU tasks one at a time."""
+        """Dispatch queued GPU tasks; each then waits for its own key's slot."""
         while True:
-            task, future = await self._queue.get()
-            try:
+            task, future, key = await self._queue.get()
+            running = asyncio.create_task(self._run(task, future, key))
+            self._running.add(running)
+            running.add_done_callback(self._running.discard)
+
+    async def _run(self, task, future: asyncio.Future, key: str):
+        """Run a single task once its key's slot is free."""
+        oom = False
+        try:
+            async with self._lock(key):
                 result = await task()
+            if not future.done():
                 future.set_result(result)
-            except Exception as e:
+        except Exception as e:
+            oom = _is_oom(e)
+            if not future.done():
                 future.set_exception(e)
-            finally:
-                self._queue.task_done()
-                # Clear GPU cache after each operation
-                try:
-                    import torch
-
-                    if torch.cuda.is_available():
-                        torch.cuda.empty_cache()
-                except Exception:
-                    pass
-
-    async def submit(self, task: Callable[[], Coroutine[None, None, T]]) -> T:
-        """Submit a task and wait for result."""
+        finally:
+            self._queue.task_done()
+
+        loop = asyncio.get_running_loop()
+        self._completed += 1
+        if self._completed % SYNC_EVERY == 0:
+            await loop.run_in_executor(gpu_executor, _synchronize)
+        if self._should_release_cache(oom):
+            await loop.run_in_executor(gpu_executor, _release_cache)
+
+    def _should_release_cache(self, oom: bool) -> bool:
+        """Decide whether to return cached blocks to the driver after a task.
+
+        Emptying the cache after every task throws away the allocator's block reuse,
+        so it only happens after an OOM or when a large amount of reserved memory
+        has sat unused for several tasks in a row.
+        """
+        if oom:
+            self._fragmented_tasks = 0
+            return True
+
+        try:
+            import torch
+
+            if not torch.cuda.is_available():
+                return False
+            unused = torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+        except Exception:
+            return False
+
+        if unused < FRAGMENTATION_THRESHOLD_BYTES:
+            self._fragmented_tasks = 0
+            return False
+
+        self._fragmented_tasks += 1
+        if self._fragmented_tasks < FRAGMENTATION_TASKS:
+            return False
+        self._fragmented_tasks = 0
+        return True
+
+    async def submit(self, task: Callable[[], Coroutine[None, None, T]], key: str = "default") -> T:
+        """Submit a task under a concurrency key and wait for result."""
         future: asyncio.Future[T] = asyncio.Future()
-        await self._queue.put((task, future))
+        await self._queue.put((task, future, key))
         return await future
 
     @property
     def pending(self) -> int:
-        """Number of pending tasks in queue."""
-        return self._queue.qsize()
+        """Number of submitted tasks that haven't finished."""
+        return self._queue.qsize() + len(self._running)
 
 
 gpu_queue = GPUQueue()
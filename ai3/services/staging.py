@@ -0,0 +1,97 @@
+"""Preallocated tensor buffers for model inputs."""
+
+import torch
+
+
+class StagingBuffer:
+    """Fixed-shape device buffer that inputs are copied into.
+
+    Copying each request into the same block keeps the caching allocator out of
+    the hot path and gives the model a stable input address. On CUDA, inputs go
+    through a matching pinned host buffer so the upload is an async DMA copy.
+    Inputs that don't fit the buffer's shape fall back to a regular transfer.
+    """
+
+    def __init__(self, shape: tuple[int, ...], dtype: torch.dtype, device: str):
+        self._buffer = torch.empty(shape, dtype=dtype, device=device)
+        self._host = None
+        self._uploaded = None
+        if self._buffer.is_cuda:
+            self._host = torch.empty(shape, dtype=dtype, pin_memory=True)
+            self._uploaded = torch.cuda.Event()
+
+    @property
+    def shape(self) -> torch.Size:
+        """Shape of the full buffer."""
+        return self._buffer.shape
+
+    def fits(self, tensor: torch.Tensor) -> bool:
+        """Whether the tensor can be staged in this buffer."""
+        return (
+            tensor.shape[0] <= self._buffer.shape[0] and tensor.shape[1:] == self._buffer.shape[1:]
+        )
+
+    def stage(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Copy a batch into the buffer and return the filled view."""
+        if not self.fits(tensor):
+            return tensor.to(self._buffer.device, self._buffer.dtype)
+
+        view = self._buffer[: tensor.shape[0]]
+        if self._host is None:
+            view.copy_(tensor)
+            return view
+
+        # Don't overwrite pinned memory that a previous upload may still be reading
+        self._uploaded.synchronize()
+        host = self._host[: tensor.shape[0]]
+        host.copy_(tensor)
+        view.copy_(host, non_blocking=True)
+        self._uploaded.record()
+        return view
+
+
+class PinnedBuffer:
+    """Growable pinned host buffer for async uploads of variable-size tensors.
+
+    Uploads run on a caller-provided copy stream as DMA copies from page-locked
+    memory. An event guards the host memory so it isn't overwritten while a
+    previous copy may still read it. The buffer grows to at most ``max_bytes``;
+    larger tensors take a regular transfer instead of pinning more host memory.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._host: torch.Tensor | None = None
+        self._max_bytes = max_bytes
+        self._copied = torch.cuda.Event()
+
+    def _view(self, shape: torch.Size, dtype: torch.dtype) -> torch.Tensor:
+        """Host view of the given shape, growing the buffer if needed."""
+        self._copied.synchronize()
+        size = torch.Size(shape).numel() * dtype.itemsize
+        if self._host is None or self._host.numel() < size:
+            self._host = torch.empty(size, dtype=torch.uint8, pin_memory=True)
+        return self._host[:size].view(dtype).view(shape)
+
+    def upload(self, tensor: torch.Tensor, stream: torch.cuda.Stream) -> torch.Tensor:
+        """Copy a CPU tensor to the GPU on the copy stream.
+
+        The current stream waits for the copy, so kernels queued after this see
+        the data without the calling thread blocking on the transfer.
+        """
+        if tensor.numel() * tensor.element_size() > self._max_bytes:
+            return tensor.to("cuda")
+
+        host = self._view(tensor.shape, tensor.dtype)
+        host.copy_(tensor)
+
+        current = torch.cuda.current_stream()
+        with torch.cuda.stream(stream):
+            # Allocated from the copy stream's pool, so the block can't still be in
+            # use by work queued on the current stream and the copy starts right away
+            device = torch.empty(tensor.shape, dtype=tensor.dtype, device="cuda")
+            device.copy_(host, non_blocking=True)
+            self._copied.record(stream)
+        # The tensor is used on the current stream from here on
+        device.record_stream(current)
+        current.wait_stream(stream)
+        return device
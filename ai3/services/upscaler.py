@@ -1,13 +1,23 @@
 """Image upscaler service using spandrel."""
 
 import asyncio
+import io
 import logging
+import math
+from collections import defaultdict
+from collections.abc import Hashable
+from contextlib import AbstractAsyncContextManager
 from pathlib import Path
-from typing import Literal
+from typing import BinaryIO, Literal, NamedTuple
 
+import numpy as np
 import torch
 
+from services.batcher import Batcher
 from services.capabilities import get_device
+from services.encoding import encode_png_array, png_executor
+from services.queue import cpu_executor, gpu_executor, gpu_queue
+from services.staging import PinnedBuffer
 
 logger = logging.getLogger(__name__)
 
@@ -17,21 +27,122 @@ MODEL_URLS = {
     4: "https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth",
 }
 
+# JPEG files start with an SOI marker followed by another marker
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+# Larger inputs are upscaled in overlapping tiles so activation memory stays bounded
+TILE_SIZE = 512
+TILE_OVERLAP = 32
+
+# Largest input staged through pinned host memory (a 4096x4096 RGBA image), so the
+# locked buffer can't grow without bound; bigger inputs take a regular transfer
+MAX_PINNED_INPUT_BYTES = 64 * 1024**2
+
+# Concurrent uploads of the same size and scale are stacked into one forward pass.
+# Kept small: the wait adds latency to every request, and activations grow with it.
+MAX_BATCH_SIZE = 4
+MAX_WAIT_MS = 5
+
+
+def _read_upload(file: BinaryIO):
+    """Read a file into a uint8 array in one copy, without an intermediate bytes object."""
+    size = file.seek(0, io.SEEK_END)
+    file.seek(0)
+    buffer = np.empty(size, np.uint8)
+    file.readinto(buffer)
+    return buffer
+
+
+def _tile_starts(size: int) -> list[int]:
+    """Offsets of full-size tiles covering one axis, the last one flush with the edge."""
+    if size <= TILE_SIZE:
+        return [0]
+    starts = list(range(0, size - TILE_SIZE, TILE_SIZE - TILE_OVERLAP))
+    starts.append(size - TILE_SIZE)
+    return starts
+
+
+def _ramp(start: int, length: int, size: int, ramp: int, like: torch.Tensor) -> torch.Tensor:
+    """Blend weights for one tile along one axis, fading in/out over interior overlaps."""
+    weights = like.new_ones(length)
+    edge = 0.5 - 0.5 * torch.cos(math.pi * (torch.arange(ramp, device=like.device) + 0.5) / ramp)
+    edge = edge.to(like.dtype)
+    if start > 0:
+        weights[:ramp] = edge
+    if start + length < size:
+        weights[-ramp:] = edge.flip(0)
+    return weights
+
+
+def _to_bgr(img: np.ndarray) -> np.ndarray:
+    """Bring an OpenCV decode to uint8 BGR or BGRA, rejecting what the model can't take."""
+    if img.dtype == np.uint16:
+        # 16-bit PNGs and TIFFs; the model works on 8-bit input anyway
+        img = (img >> 8).astype(np.uint8)
+    elif img.dtype != np.uint8:
+        raise ValueError(f"Unsupported pixel type: {img.dtype}")
+
+    if img.ndim == 2:
+        img = img[:, :, None]
+    channels = img.shape[2]
+    if channels == 1:
+        return img[:, :, [0, 0, 0]]
+    if channels == 2:
+        # Gray with alpha
+        return img[:, :, [0, 0, 0, 1]]
+    if channels not in (3, 4):
+        raise ValueError(f"Unsupported channel count: {channels}")
+    return img
+
+
+def _load_turbojpeg():
+    """Create a TurboJPEG decoder if PyTurboJPEG and libturbojpeg are installed."""
+    try:
+        from turbojpeg import TurboJPEG
+
+        return TurboJPEG()
+    except Exception:
+        return None
+
+
+class DecodedImage(NamedTuple):
+    """An upload decoded on the CPU, ready for the GPU stage."""
+
+    pixels: torch.Tensor  # uint8 HWC with 3 or 4 channels, or the raw bytes of a JPEG
+    jpeg: bool  # pixels still holds an encoded JPEG for nvJPEG
+    bgr: bool  # channels are in OpenCV's BGR(A) order
+
 
 class Upscaler:
-    """Spandrel-based image upscaler supporting Real-ESRGAN models."""
+    """Spandrel-based image upscaler supporting Real-ESRGAN models.
+
+    An upscale runs in three stages: ``decode`` on the CPU pool, ``upscale`` on the
+    GPU thread and ``encode`` on the PNG pool, so only the model run holds the GPU.
+    """
 
     def __init__(self):
         self._models: dict[int, torch.nn.Module] = {}
         self._device = None
+        self._memory_format = torch.contiguous_format
+        self._tile_buffers: dict[int, torch.Tensor] = {}
+        self._turbojpeg = None
+        self._copy_stream: torch.cuda.Stream | None = None
+        self._input_buffer: PinnedBuffer | None = None
+        self._batcher: Batcher[DecodedImage, np.ndarray] = Batcher(
+            self._run_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS
+        )
 
     async def load(self):
         """Load upscaler models."""
         self._device = get_device()
+        self._memory_format = (
+            torch.channels_last if self._device == "cuda" else torch.contiguous_format
+        )
+        self._turbojpeg = _load_turbojpeg()
         logger.info(f"Loading upscaler models on {self._device}...")
 
         loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self._load_models)
+        await loop.run_in_executor(gpu_executor, self._load_models)
 
         logger.info("Upscaler models loaded")
 
@@ -58,23 +169,59 @@ class Upscaler:
             model = model.to(self._device)
             if self._device == "cuda":
                 model = model.half()  # Use fp16 on GPU
+                # NHWC lets cuDNN pick its faster convolution kernels
+                model.model.to(memory_format=torch.channels_last)
             model.eval()
 
             self._models[scale] = model
 
+            # Every tile is copied into this block, so tiling never allocates new inputs
+            dtype = torch.float16 if self._device == "cuda" else torch.float32
+            self._tile_buffers[scale] = torch.empty(
+                (MAX_BATCH_SIZE, 3, TILE_SIZE, TILE_SIZE),
+                dtype=dtype,
+                device=self._device,
+                memory_format=self._memory_format,
+            )
+
+        if self._device == "cuda":
+            self._copy_stream = torch.cuda.Stream()
+            self._input_buffer = PinnedBuffer(MAX_PINNED_INPUT_BYTES)
+
+    def reserve(self, scale: Literal[2, 4]) -> AbstractAsyncContextManager[None]:
+        """Hold a pending slot for one request at this scale, from decode to result.
+
+        Raises QueueFullError if no slot frees up in time, before any decode work.
+        """
+        return self._batcher.reserve(scale)
+
+    async def decode(self, image: BinaryIO) -> DecodedImage:
+        """Decode an upload on the CPU pool, ahead of its turn on the GPU.
+
+        Args:
+            image: Input image file (e.g. the upload's spooled file)
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(cpu_executor, self._decode_sync, image)
+
     async def upscale(
         self,
-        image_bytes: bytes,
+        image: DecodedImage,
         scale: Literal[2, 4] = 4,
-    ) -> bytes:
-        """Upscale an image.
+    ) -> np.ndarray:
+        """Upscale a decoded image.
+
+        Concurrent requests for the same scale are batched, and the batch is run on
+        the GPU queue.
+
+        Call decode() and this inside reserve() for the same scale.
 
         Args:
-            image_bytes: Input image as bytes
+            image: Image from decode()
             scale: Upscale factor (2 or 4)
 
         Returns:
-            Upscaled image as PNG bytes
+            Upscaled RGB(A) image as a uint8 HWC array
         """
         if scale not in (2, 4):
             raise ValueError(f"Scale must be 2 or 4, got {scale}")
@@ -82,73 +229,196 @@ class Upscaler:
         if scale not in self._models:
             raise RuntimeError(f"Model for scale {scale} not loaded. Call load() first.")
 
+        return await self._batcher.submit(scale, image)
+
+    async def stop(self):
+        """Stop the request batcher."""
+        await self._batcher.stop()
+
+    async def _run_batch(
+        self, key: Hashable, batch: list[DecodedImage]
+    ) -> list[np.ndarray | Exception]:
+        """Upscale a batch of images on the GPU queue."""
+        scale = key
+
+        async def do_upscale():
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(gpu_executor, self._upscale_sync, batch, scale)
+
+        return await gpu_queue.submit(do_upscale, key=f"upscale:x{scale}")
+
+    async def encode(self, output: np.ndarray) -> bytes:
+        """Encode an upscaled image as PNG on the encoder thread pool.
+
+        Args:
+            output: Array from upscale()
+
+        Returns:
+            Upscaled image as PNG bytes
+        """
         loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            self._upscale_sync,
-            image_bytes,
-            scale,
-        )
-        return result
+        return await loop.run_in_executor(png_executor, encode_png_array, output)
 
-    def _upscale_sync(self, image_bytes: bytes, scale: int) -> bytes:
-        """Synchronous upscaling operation."""
-        import cv2
-        import numpy as np
+    def _decode_sync(self, image: BinaryIO) -> DecodedImage:
+        """Decode to a uint8 HWC tensor, keeping the alpha channel if any.
 
-        model = self._models[scale]
+        Channel reordering, conversion to float and the alpha split are left to the
+        device, so only uint8 pixels are copied to the GPU.
+        """
+        import cv2
 
-        # Decode image
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+        data = _read_upload(image)
+        is_jpeg = data[:3].tobytes() == JPEG_MAGIC
+        if self._device == "cuda" and is_jpeg:
+            # Left for nvJPEG to decode on the GPU straight to RGB, skipping the CPU
+            # decode and the host-to-device copy of the full image
+            return DecodedImage(torch.from_numpy(data), jpeg=True, bgr=False)
+
+        if is_jpeg and self._turbojpeg is not None:
+            # libjpeg-turbo called directly, decoding straight to RGB
+            from turbojpeg import TJPF_RGB
+
+            try:
+                img = self._turbojpeg.decode(data, pixel_format=TJPF_RGB)
+            except OSError as e:
+                raise ValueError(f"Failed to decode image: {e}") from None
+            bgr = False
+        else:
+            img = cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+
+            if img is None:
+                raise ValueError("Failed to decode image")
+            img = _to_bgr(img)
+            bgr = True
+
+        return DecodedImage(torch.from_numpy(img), jpeg=False, bgr=bgr)
+
+    def _decode_jpeg_cpu(self, data: torch.Tensor) -> DecodedImage:
+        """Decode a JPEG that nvJPEG couldn't with OpenCV instead."""
+        import cv2
 
+        img = cv2.imdecode(data.numpy(), cv2.IMREAD_UNCHANGED)
         if img is None:
             raise ValueError("Failed to decode image")
+        return DecodedImage(torch.from_numpy(_to_bgr(img)), jpeg=False, bgr=True)
 
-        # Handle different image modes
-        has_alpha = len(img.shape) == 3 and img.shape[2] == 4
-        if has_alpha:
-            # Separate alpha channel
-            alpha = img[:, :, 3]
-            img = img[:, :, :3]
+    def _to_device(self, image: DecodedImage) -> torch.Tensor:
+        """Move a decoded image to the device as a normalized NCHW RGB(A) tensor."""
+        if image.jpeg:
+            from torchvision.io import ImageReadMode, decode_jpeg
 
-        # Convert BGR to RGB
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            try:
+                img = decode_jpeg(image.pixels, mode=ImageReadMode.RGB, device="cuda")
+                return img.unsqueeze(0).half().div_(255.0)
+            except RuntimeError:
+                # nvJPEG rejects some valid JPEGs (arithmetic coding, lossless), so
+                # decode those on the CPU and upload them like any other image
+                image = self._decode_jpeg_cpu(image.pixels)
 
-        # Convert to tensor: HWC -> CHW, normalize to 0-1
-        img_tensor = torch.from_numpy(img).permute(2, 0, 1).float() / 255.0
-        img_tensor = img_tensor.unsqueeze(0)  # Add batch dimension
-
-        # Move to device and convert to fp16 if on GPU
-        img_tensor = img_tensor.to(self._device)
         if self._device == "cuda":
-            img_tensor = img_tensor.half()
+            # uint8 goes through pinned memory on a copy stream: 3 bytes per pixel
+            # over PCIe instead of 12 for float32
+            img = self._input_buffer.upload(image.pixels, self._copy_stream)
+            dtype = torch.float16
+        else:
+            img = image.pixels
+            dtype = torch.float32
+
+        # HWC -> NCHW, BGR(A) -> RGB(A) by channel index, folded into the float conversion
+        img = img.permute(2, 0, 1)
+        if image.bgr:
+            img = img[[2, 1, 0, 3][: img.shape[0]]]
+        return img.unsqueeze(0).to(dtype).div_(255.0)
+
+    def _tile_forward(self, model: torch.nn.Module, img: torch.Tensor, scale: int) -> torch.Tensor:
+        """Run the model over overlapping tiles and blend them with cosine ramps.
+
+        Blend weights are separable, so the sum of all tile weights at a pixel is
+        the product of a per-row and a per-column sum; the output is normalized by
+        those two vectors instead of a full-size weight map.
+        """
+        batch_size, channels, height, width = img.shape
+        if height <= TILE_SIZE and width <= TILE_SIZE:
+            return model(img.contiguous(memory_format=self._memory_format))
+
+        tile_h = min(TILE_SIZE, height)
+        tile_w = min(TILE_SIZE, width)
+        ramp = TILE_OVERLAP * scale
+        out = img.new_zeros((batch_size, channels, height * scale, width * scale))
+        row_norm = img.new_zeros(height * scale)
+        col_norm = img.new_zeros(width * scale)
+
+        rows = []
+        for y in _tile_starts(height):
+            weights = _ramp(y * scale, tile_h * scale, height * scale, ramp, img)
+            row_norm[y * scale : (y + tile_h) * scale] += weights
+            rows.append((y, weights))
+        cols = []
+        for x in _tile_starts(width):
+            weights = _ramp(x * scale, tile_w * scale, width * scale, ramp, img)
+            col_norm[x * scale : (x + tile_w) * scale] += weights
+            cols.append((x, weights))
+
+        tile = self._tile_buffers[scale][:batch_size, :, :tile_h, :tile_w]
+        for y, row_weights in rows:
+            for x, col_weights in cols:
+                tile.copy_(img[:, :, y : y + tile_h, x : x + tile_w], non_blocking=True)
+                result = model(tile)
+                out[:, :, y * scale : (y + tile_h) * scale, x * scale : (x + tile_w) * scale] += (
+                    result * row_weights[:, None] * col_weights[None, :]
+                )
+
+        return out.div_(row_norm[:, None] * col_norm[None, :])
+
+    def _upscale_sync(self, images: list[DecodedImage], scale: int) -> list[np.ndarray | Exception]:
+        """Synchronous upscaling operation.
+
+        Images of the same size go through the model as one stacked batch. A JPEG
+        that neither nvJPEG nor OpenCV can decode fails only its own request.
+        """
+        results: list[np.ndarray | Exception] = [None] * len(images)
+        tensors: dict[int, torch.Tensor] = {}
+        groups: dict[torch.Size, list[int]] = defaultdict(list)
+        for i, image in enumerate(images):
+            try:
+                tensors[i] = self._to_device(image)
+            except ValueError as e:
+                results[i] = e
+                continue
+            groups[tensors[i].shape].append(i)
+
+        for indices in groups.values():
+            output = self._upscale_tensor(torch.cat([tensors[i] for i in indices]), scale)
+            for i, result in zip(indices, output.cpu().numpy(), strict=True):
+                results[i] = result
+        return results
+
+    def _upscale_tensor(self, img_tensor: torch.Tensor, scale: int) -> torch.Tensor:
+        """Upscale a normalized NCHW RGB(A) batch into uint8 NHWC."""
+        import torch.nn.functional as F
 
-        # Upscale
-        with torch.no_grad():
-            output = model(img_tensor)
-
-        # Convert back: CHW -> HWC, denormalize
-        output = output.squeeze(0).permute(1, 2, 0).float().cpu().numpy()
-        output = (output * 255.0).clip(0, 255).astype(np.uint8)
-
-        # Convert RGB to BGR
-        output = cv2.cvtColor(output, cv2.COLOR_RGB2BGR)
-
-        # Handle alpha channel
-        if has_alpha:
-            # Upscale alpha separately using simple resize
-            alpha_upscaled = cv2.resize(
-                alpha,
-                (output.shape[1], output.shape[0]),
-                interpolation=cv2.INTER_LANCZOS4,
-            )
-            output = cv2.cvtColor(output, cv2.COLOR_BGR2BGRA)
-            output[:, :, 3] = alpha_upscaled
+        model = self._models[scale]
+        rgb, alpha = img_tensor[:, :3], img_tensor[:, 3:]
 
-        # Encode as PNG
-        _, buffer = cv2.imencode(".png", output)
-        return buffer.tobytes()
+        # Upscale
+        with torch.inference_mode():
+            output = self._tile_forward(model, rgb, scale)
+
+            if alpha.shape[1]:
+                # The model only handles RGB; resize alpha separately on the device
+                alpha = F.interpolate(
+                    alpha, scale_factor=scale, mode="bicubic", align_corners=False
+                )
+                output = torch.cat((output, alpha), dim=1)
+
+            # Denormalize, quantize and go NCHW -> NHWC on the device so only packed
+            # uint8 is copied back. The output is ours, so the element-wise steps run in
+            # place (inside inference mode, which forbids in-place updates of its
+            # tensors outside it) instead of each allocating another full-size float
+            # tensor. A channels_last output is already NHWC in memory, making the last
+            # step free.
+            output = output.clamp_(0, 1).mul_(255.0).round_().to(torch.uint8)
+            return output.permute(0, 2, 3, 1).contiguous()
 
 
 upscaler = Upscaler()